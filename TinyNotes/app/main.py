@@ -1,110 +1,281 @@
 from __future__ import annotations
+import asyncio
+import queue
+import secrets
 import time
 import threading
-import uuid
+from collections import OrderedDict
 from typing import Optional, Dict, List
 
-from fastapi import FastAPI, HTTPException, Header, Depends, Request
-from fastapi.responses import JSONResponse, PlainTextResponse, HTMLResponse
+import orjson
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import ORJSONResponse, PlainTextResponse
 from pydantic import BaseModel, Field
 
+# Use the libuv-backed event loop when available (2-6x lower loop overhead).
+# Optional so the app still runs where uvloop doesn't build (e.g., Windows).
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:  # pragma: no cover
+    pass
+
+# Everything is registered against this single app instance; re-running
+# decorator blocks (e.g., from a careless merge) would double-register
+# middleware, which tests guard against.
+__all__ = ["app", "handler"]
+
 app = FastAPI(
     title="TinyNotes API",
     version="1.0.0",
     description="A tiny in-memory notes API with idempotency, rate limits, and simple metrics.",
+    default_response_class=ORJSONResponse,
 )
 
 # ---------- Simple models ----------
+# Pydantic validates input only; responses are plain dicts serialized by
+# orjson, skipping model construction on the hot read path.
 class NoteCreate(BaseModel):
     content: str = Field(min_length=1, max_length=240)
 
-class NoteOut(BaseModel):
-    id: str
-    content: str
-    createdAt: int
-
 # ---------- In-memory stores (demo only) ----------
-NOTES: List[NoteOut] = []
-IDEMPOTENCY: Dict[str, Dict[str, dict]] = {}  # scope -> key -> response
-STORE_LOCK = threading.RLock()
+class LRUCache:
+    """Fixed-capacity cache evicting the least recently used entry."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.data: OrderedDict[str, bytes] = OrderedDict()
+
+    def get(self, key: str) -> Optional[bytes]:
+        val = self.data.get(key)
+        if val is not None:
+            self.data.move_to_end(key)
+        return val
+
+    def put(self, key: str, value: bytes):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.capacity:
+            self.data.popitem(last=False)
+
+NOTES: List[dict] = []
+# scope -> key -> encoded response; bounded so idempotency keys can't leak memory
+IDEMPOTENCY: Dict[str, LRUCache] = {"create_note": LRUCache(10_000)}
+
+# Striped locking: keys hash onto 16 locks so unrelated keys don't
+# serialize through one global mutex on the hot dispatch paths.
+NUM_SHARDS = 16
+SHARD_LOCKS = [threading.Lock() for _ in range(NUM_SHARDS)]
+
+def shard_lock(key: str) -> threading.Lock:
+    return SHARD_LOCKS[hash(key) & (NUM_SHARDS - 1)]
 
 def now() -> int:
     return int(time.time())
 
 # ---------- Rate limiting (token bucket per API key) ----------
+# One token, scaled so refill math stays in integers:
+# elapsed_ns * rate_per_sec == tokens * 1e9.
+ONE_TOKEN = 1_000_000_000
+
 class TokenBucket:
-    def __init__(self, rate_per_sec: float, burst: int):
+    def __init__(self, rate_per_sec: int, burst: int):
         self.rate = rate_per_sec
-        self.capacity = burst
-        self.tokens = burst
-        self.last = time.time()
-        self.lock = threading.Lock()
+        self.capacity = burst * ONE_TOKEN
+        self.tokens = self.capacity
+        self.last = time.monotonic_ns()
 
     def allow(self) -> bool:
-        with self.lock:
-            t = time.time()
-            elapsed = t - self.last
-            self.last = t
-            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
-            if self.tokens >= 1.0:
-                self.tokens -= 1.0
-                return True
-            return False
+        # Only ever called from the event loop thread (rate_limit is an
+        # async dependency), so one coroutine runs at a time and no lock
+        # is needed around the integer refill-and-compare.
+        t = time.monotonic_ns()
+        self.tokens = min(self.capacity, self.tokens + (t - self.last) * self.rate)
+        self.last = t
+        if self.tokens >= ONE_TOKEN:
+            self.tokens -= ONE_TOKEN
+            return True
+        return False
 
 BUCKETS: Dict[str, TokenBucket] = {}
-BUCKETS_LOCK = threading.Lock()
 DEV_API_KEY = "dev-key"
 
-def rate_limit(x_api_key: Optional[str] = Header(default=None)) -> str:
-    key = x_api_key or DEV_API_KEY
-    with BUCKETS_LOCK:
-        bucket = BUCKETS.get(key)
-        if bucket is None:
-            bucket = TokenBucket(rate_per_sec=10.0, burst=20)
-            BUCKETS[key] = bucket
-    if not bucket.allow():
-        raise HTTPException(status_code=429, detail="rate_limit_exceeded")
-    return key
-
-# ---------- Metrics (simple p95 per endpoint) ----------
-DURS: Dict[str, List[float]] = {}
+# Browser/doc pages don't burn API buckets.
+RATE_LIMIT_EXEMPT = {"/", "/docs", "/redoc", "/openapi.json"}
+
+def rate_limit(key: str) -> bool:
+    # Called from the middleware on the event loop; setdefault is
+    # race-free there since only one coroutine runs at a time.
+    bucket = BUCKETS.get(key)
+    if bucket is None:
+        bucket = BUCKETS.setdefault(key, TokenBucket(rate_per_sec=10, burst=20))
+    return bucket.allow()
+
+# ---------- Metrics (streaming p95 per endpoint) ----------
+class PSquare:
+    """Online quantile estimator (Jain & Chlamtac's P-squared algorithm).
+
+    Tracks a single quantile with 5 markers: O(1) update per sample and
+    fixed memory, instead of buffering and re-sorting 1000 samples.
+    """
+
+    def __init__(self, quantile: float = 0.95):
+        self.q = quantile
+        self.heights: List[float] = []  # first 5 observations, then marker heights
+        self.pos = [1, 2, 3, 4, 5]
+        self.desired = [1.0, 1 + 2 * quantile, 1 + 4 * quantile, 3 + 2 * quantile, 5.0]
+        self.increments = [0.0, quantile / 2, quantile, (1 + quantile) / 2, 1.0]
+
+    def update(self, x: float):
+        h = self.heights
+        if len(h) < 5:
+            h.append(x)
+            h.sort()
+            return
+        # Find the cell containing x, widening the extremes as needed.
+        if x < h[0]:
+            h[0] = x
+            k = 0
+        elif x >= h[4]:
+            h[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= h[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            self.pos[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+        # Nudge the middle markers toward their desired positions.
+        for i in range(1, 4):
+            d = self.desired[i] - self.pos[i]
+            if (d >= 1 and self.pos[i + 1] - self.pos[i] > 1) or (
+                d <= -1 and self.pos[i - 1] - self.pos[i] < -1
+            ):
+                d = 1 if d > 0 else -1
+                hp = self._parabolic(i, d)
+                if h[i - 1] < hp < h[i + 1]:
+                    h[i] = hp
+                else:
+                    h[i] = self._linear(i, d)
+                self.pos[i] += d
+
+    def _parabolic(self, i: int, d: int) -> float:
+        h, n = self.heights, self.pos
+        return h[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (h[i + 1] - h[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - d) * (h[i] - h[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def _linear(self, i: int, d: int) -> float:
+        h, n = self.heights, self.pos
+        return h[i] + d * (h[i + d] - h[i]) / (n[i + d] - n[i])
+
+    def value(self) -> float:
+        h = self.heights
+        if not h:
+            return 0.0
+        if len(h) < 5:
+            # Not enough samples to form markers; fall back to the sorted list.
+            idx = max(0, int(round(self.q * len(h))) - 1)
+            return h[idx]
+        return h[2]
+
+EST: Dict[str, PSquare] = {}
 COUNTS: Dict[str, int] = {}
-METRICS_LOCK = threading.RLock()
-
-def record_metric(name: str, dur_ms: float):
-    with METRICS_LOCK:
-        arr = DURS.get(name)
-        if arr is None:
-            arr = []
-            DURS[name] = arr
-        arr.append(dur_ms)
-        if len(arr) > 1000:
-            del arr[: len(arr) - 1000]
-        COUNTS[name] = COUNTS.get(name, 0) + 1
-
-def p95(arr: List[float]) -> float:
-    if not arr:
-        return 0.0
-    s = sorted(arr)
-    idx = max(0, int(round(0.95 * (len(s))) - 1))
-    return s[idx]
+
+# Requests only enqueue samples; EST/COUNTS are touched solely from the
+# event loop thread (aggregator task and /metrics), so no lock is needed.
+METRIC_Q: queue.SimpleQueue = queue.SimpleQueue()
+
+def _apply_metric(name: str, dur_ms: float):
+    est = EST.get(name)
+    if est is None:
+        est = PSquare(0.95)
+        EST[name] = est
+    est.update(dur_ms)
+    COUNTS[name] = COUNTS.get(name, 0) + 1
+
+def _drain_pending():
+    while True:
+        try:
+            item = METRIC_Q.get_nowait()
+        except queue.Empty:
+            return
+        if item is not None:
+            _apply_metric(*item)
+
+async def _drain_metrics():
+    # The blocking get() runs on the threadpool; the apply runs back on
+    # the event loop once an item arrives.
+    loop = asyncio.get_running_loop()
+    while True:
+        item = await loop.run_in_executor(None, METRIC_Q.get)
+        if item is None:  # shutdown sentinel
+            return
+        _apply_metric(*item)
+
+@app.on_event("startup")
+async def _start_metrics_aggregator():
+    app.state.metrics_task = asyncio.create_task(_drain_metrics())
+
+@app.on_event("shutdown")
+async def _stop_metrics_aggregator():
+    METRIC_Q.put_nowait(None)
+    await app.state.metrics_task
+
+class HealthzShortCircuit:
+    """Pure-ASGI fast path for load-balancer probes.
+
+    Answers /healthz before routing, rate limiting, or metrics run, so
+    the highest-frequency endpoint costs two sends and no locks.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == "/healthz":
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 200,
+                    "headers": [
+                        (b"content-type", b"text/plain; charset=utf-8"),
+                        (b"content-length", b"2"),
+                    ],
+                }
+            )
+            await send({"type": "http.response.body", "body": b"ok"})
+            return
+        await self.app(scope, receive, send)
 
 @app.middleware("http")
 async def timing_mw(request: Request, call_next):
     start = time.time()
     try:
+        # Rate limiting lives here rather than in a Depends() so requests
+        # skip FastAPI's per-call dependency resolution entirely.
+        if request.url.path not in RATE_LIMIT_EXEMPT:
+            key = request.headers.get("x-api-key") or DEV_API_KEY
+            if not rate_limit(key):
+                return ORJSONResponse({"detail": "rate_limit_exceeded"}, status_code=429)
         return await call_next(request)
     finally:
         dur = (time.time() - start) * 1000.0
         route = request.scope.get("route")
         path = getattr(route, "path", request.url.path)
         name = f"{request.method} {path}"
-        record_metric(name, dur)
+        METRIC_Q.put_nowait((name, dur))
+
+# Added last so it runs outermost, ahead of timing_mw.
+app.add_middleware(HealthzShortCircuit)
 
 # ---------- Endpoints ----------
-@app.get("/", response_class=HTMLResponse, include_in_schema=False)
-async def home():
-    return """
+# The home page is constant, so encode it to bytes once at import time
+# instead of rebuilding and re-encoding ~3 KB of HTML on every request.
+_HOME_HTML = """
     <!doctype html>
     <html lang=\"en\">
     <head>
@@ -241,40 +412,48 @@ async def home():
     </body>
     </html>
     """
+HOME_BYTES = _HOME_HTML.encode("utf-8")
+
+@app.get("/", include_in_schema=False)
+async def home():
+    return Response(HOME_BYTES, media_type="text/html; charset=utf-8")
 
+# Fallback only; probes are normally answered by HealthzShortCircuit.
 @app.get("/healthz", response_class=PlainTextResponse)
-async def healthz(_: str = Depends(rate_limit)):
+async def healthz():
     return "ok"
 
-@app.post("/notes", response_model=NoteOut, status_code=201)
-async def create_note(
-    body: NoteCreate,
-    idem_key: Optional[str] = Header(default=None, alias="Idempotency-Key"),
-    _: str = Depends(rate_limit),
-):
+@app.post("/notes", status_code=201)
+async def create_note(body: NoteCreate, request: Request):
+    # Raw header read; no Header() alias parsing per request.
+    idem_key = request.headers.get("idempotency-key")
     if not idem_key:
         raise HTTPException(status_code=400, detail="missing Idempotency-Key header")
-    # idempotency check and create within a single critical section
-    with STORE_LOCK:
-        saved = IDEMPOTENCY.get("create_note", {}).get(idem_key)
-        if saved:
-            return saved
-
-        note = NoteOut(id=str(uuid.uuid4())[:8], content=body.content, createdAt=now())
+    # idempotency check and create within a single critical section,
+    # locked per idempotency key rather than globally
+    cache = IDEMPOTENCY["create_note"]
+    with shard_lock(idem_key):
+        saved = cache.get(idem_key)
+        if saved is not None:
+            # Replay is a straight copy of the bytes encoded on first create.
+            return Response(saved, status_code=201, media_type="application/json")
+
+        note = {"id": secrets.token_hex(4), "content": body.content, "createdAt": now()}
         NOTES.append(note)
-        IDEMPOTENCY.setdefault("create_note", {})[idem_key] = note.model_dump()
+        cache.put(idem_key, orjson.dumps(note))
         return note
 
-@app.get("/notes", response_model=List[NoteOut])
-async def list_notes(_: str = Depends(rate_limit)):
-    with STORE_LOCK:
-        return NOTES
+@app.get("/notes")
+async def list_notes():
+    # Lock-free read: NOTES is append-only and list.append is atomic in
+    # CPython, so slicing a captured length snapshots a consistent prefix.
+    return NOTES[: len(NOTES)]
 
 @app.get("/metrics")
-async def metrics(_: str = Depends(rate_limit)):
-    with METRICS_LOCK:
-        snap = {k: {"count": COUNTS.get(k, 0), "p95_ms": round(p95(v), 2)} for k, v in DURS.items()}
-    return snap
+async def metrics():
+    # Flush anything still queued so the snapshot is up to date.
+    _drain_pending()
+    return {k: {"count": COUNTS.get(k, 0), "p95_ms": round(est.value(), 2)} for k, est in EST.items()}
 
 # AWS Lambda adapter (optional)
 try:
@@ -282,3 +461,18 @@ try:
     handler = Mangum(app)
 except Exception:  # pragma: no cover
     handler = None
+
+if __name__ == "__main__":
+    import os
+    import uvicorn
+
+    # One worker per core. All stores here are in-memory and per-process
+    # (demo only), so each worker keeps its own notes/buckets/metrics.
+    uvicorn.run(
+        "app.main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=os.cpu_count() or 1,
+        loop="uvloop",
+        http="httptools",
+    )
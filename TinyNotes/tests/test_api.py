@@ -1,5 +1,7 @@
+import random
+
 from fastapi.testclient import TestClient
-from app.main import app, DEV_API_KEY
+from app.main import app, DEV_API_KEY, PSquare, timing_mw
 
 client = TestClient(app)
 headers = {"X-API-Key": DEV_API_KEY}
@@ -36,3 +38,18 @@ def test_create_list_metrics():
     assert r.status_code == 200
     snap = r.json()
     assert any(k.startswith("GET ") for k in snap)
+
+def test_timing_middleware_registered_once():
+    # A duplicated module body (bad merge) would re-register the timing
+    # middleware and double-count every request's metrics.
+    registered = [m for m in app.user_middleware if m.kwargs.get("dispatch") is timing_mw]
+    assert len(registered) == 1
+
+def test_psquare_tracks_p95():
+    rng = random.Random(42)
+    samples = [rng.expovariate(1 / 20) for _ in range(5000)]
+    est = PSquare(0.95)
+    for x in samples:
+        est.update(x)
+    true_p95 = sorted(samples)[int(0.95 * len(samples)) - 1]
+    assert abs(est.value() - true_p95) / true_p95 < 0.05